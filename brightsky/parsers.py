@@ -1,13 +1,16 @@
+import bisect
 import csv
 import datetime
 import io
 import logging
+import mmap
+import operator
 import re
+import struct
 import zipfile
 
-import dateutil.parser
-from dateutil.tz import tzutc
-from parsel import Selector
+from isal import isal_zlib
+from lxml import etree
 
 from brightsky.utils import cache_path, download
 
@@ -43,51 +46,143 @@ class MOSMIXParser(Parser):
         'SunD1': 'sunshine',
         'PPPP': 'pressure_msl',
     }
+    COLUMNS = ('timestamp', *ELEMENTS.values())
+
+    NAMESPACES = {
+        'kml': 'http://www.opengis.net/kml/2.2',
+        'dwd': (
+            'https://opendata.dwd.de/weather/lib/'
+            'pointforecast_dwd_extension_V1_0.xsd'),
+    }
+    PRODUCT_DEFINITION_PATH = (
+        'kml:Document/kml:ExtendedData/dwd:ProductDefinition')
+    FORECASTS_XPATH = etree.XPath(
+        'kml:ExtendedData/dwd:Forecast', namespaces=NAMESPACES)
+    ELEMENT_NAME_ATTRIBUTE = f'{{{NAMESPACES["dwd"]}}}elementName'
+
+    # ZIP local file header layout, see section 4.3.7 of the ZIP APPNOTE
+    LOCAL_FILE_HEADER_STRUCT = struct.Struct('<4s2B4HL2L2H')
+    LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
 
     def parse(self):
-        sel = self.get_selector()
-        timestamps = self.parse_timestamps(sel)
-        source = self.parse_source(sel)
-        logger.debug(
-            'Got %d timestamps for source %s', len(timestamps), source)
-        station_selectors = sel.css('Placemark')
-        for i, station_sel in enumerate(station_selectors):
-            logger.debug(
-                'Parsing station %d / %d', i+1, len(station_selectors))
-            yield from self.parse_station(station_sel, timestamps, source)
-
-    def get_selector(self):
+        yield from self.parse_kml(self.read_kml())
+
+    def read_kml(self, chunk_size=2**16):
+        # Inflate the KMZ's only member ourselves rather than through
+        # zipfile, which is bound to the (slower) stdlib zlib
         with zipfile.ZipFile(self.path) as zf:
             infolist = zf.infolist()
-            assert len(infolist) == 1, f'Unexpected zip content in {self.path}'
-            with zf.open(infolist[0]) as f:
-                sel = Selector(f.read().decode('latin1'), type='xml')
-        sel.remove_namespaces()
-        return sel
-
-    def parse_timestamps(self, sel):
+        assert len(infolist) == 1, f'Unexpected zip content in {self.path}'
+        info = infolist[0]
+        assert info.compress_type == zipfile.ZIP_DEFLATED, (
+            f'Unexpected compression type in {self.path}')
+        with open(self.path, 'rb') as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            signature, *_, filename_length, extra_length = (
+                self.LOCAL_FILE_HEADER_STRUCT.unpack_from(
+                    mm, info.header_offset))
+            assert signature == self.LOCAL_FILE_HEADER_SIGNATURE, (
+                f'Bad local file header in {self.path}')
+            start = (
+                info.header_offset + self.LOCAL_FILE_HEADER_STRUCT.size +
+                filename_length + extra_length)
+            end = start + info.compress_size
+            if end > len(mm):
+                raise zipfile.BadZipFile(
+                    f'Unexpected end of file in {self.path}')
+            decompressor = isal_zlib.decompressobj(-isal_zlib.MAX_WBITS)
+            crc = size = 0
+            with memoryview(mm) as data:
+                for offset in range(start, end, chunk_size):
+                    chunk = decompressor.decompress(
+                        data[offset:min(offset + chunk_size, end)])
+                    crc = isal_zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    yield chunk
+            chunk = decompressor.flush()
+            crc = isal_zlib.crc32(chunk, crc)
+            size += len(chunk)
+            # Same integrity checks that zipfile's ZipExtFile performs
+            if not decompressor.eof or size != info.file_size:
+                raise zipfile.BadZipFile(
+                    f'Truncated deflate stream for file {info.filename!r}')
+            if crc != info.CRC:
+                raise zipfile.BadZipFile(
+                    f'Bad CRC-32 for file {info.filename!r}')
+            yield chunk
+
+    def parse_kml(self, chunks):
+        # Same hardening and leniency as parsel's XML parser, which we used
+        # to parse the (downloaded) KML with
+        parser = etree.XMLPullParser(
+            tag=f'{{{self.NAMESPACES["kml"]}}}Placemark',
+            resolve_entities=False, no_network=True, recover=True)
+        timestamps = source = None
+        i = 0
+        for chunk in chunks:
+            parser.feed(chunk)
+            for _, placemark in parser.read_events():
+                if timestamps is None:
+                    # The product definition precedes all placemarks
+                    root = placemark.getroottree().getroot()
+                    timestamps = self.parse_timestamps(root)
+                    source = self.parse_source(root)
+                    logger.debug(
+                        'Got %d timestamps for source %s',
+                        len(timestamps), source)
+                i += 1
+                logger.debug('Parsing station %d', i)
+                yield from self.parse_station(placemark, timestamps, source)
+                # Drop parsed elements so that memory usage stays flat
+                placemark.clear()
+                while placemark.getprevious() is not None:
+                    del placemark.getparent()[0]
+        parser.close()
+
+    def parse_timestamps(self, root):
         return [
-            dateutil.parser.parse(ts)
-            for ts in sel.css('ForecastTimeSteps > TimeStep::text').extract()]
-
-    def parse_source(self, sel):
-        return ':'.join(sel.css('ProductID::text, IssueTime::text').extract())
-
-    def parse_station(self, station_sel, timestamps, source):
-        station_id = station_sel.css('name::text').extract_first()
-        lat, lon, height = station_sel.css(
-            'coordinates::text').extract_first().split(',')
+            datetime.datetime.strptime(
+                ts, '%Y-%m-%dT%H:%M:%S.%fZ'
+            ).replace(tzinfo=datetime.timezone.utc)
+            for ts in root.xpath(
+                f'{self.PRODUCT_DEFINITION_PATH}/dwd:ForecastTimeSteps'
+                '/dwd:TimeStep/text()',
+                namespaces=self.NAMESPACES)]
+
+    def parse_source(self, root):
+        product_definition = root.find(
+            self.PRODUCT_DEFINITION_PATH, self.NAMESPACES)
+        return ':'.join(
+            product_definition.findtext(tag, namespaces=self.NAMESPACES)
+            for tag in ['dwd:ProductID', 'dwd:IssueTime'])
+
+    def parse_station(self, placemark, timestamps, source):
+        station_id = placemark.findtext('kml:name', namespaces=self.NAMESPACES)
+        lat, lon, height = placemark.findtext(
+            'kml:Point/kml:coordinates', namespaces=self.NAMESPACES
+        ).split(',')
         records = {'timestamp': timestamps}
-        for element, column in self.ELEMENTS.items():
-            values_str = station_sel.css(
-                f'Forecast[elementName="{element}"] value::text'
-            ).extract_first()
-            records[column] = [
-                None if row[0] == '-' else float(row[0])
-                for row in csv.reader(
-                    re.sub(r'\s+', '\n', values_str.strip()).splitlines())
-            ]
+        for forecast in self.FORECASTS_XPATH(placemark):
+            column = self.ELEMENTS.get(
+                forecast.get(self.ELEMENT_NAME_ATTRIBUTE))
+            if not column:
+                continue
+            values_str = forecast.findtext(
+                'dwd:value', namespaces=self.NAMESPACES)
+            if '-' not in values_str:
+                # Fast path for the common case of no missing values
+                records[column] = list(map(float, values_str.split()))
+            else:
+                records[column] = [
+                    None if value == '-' else float(value)
+                    for value in values_str.split()
+                ]
             assert len(records[column]) == len(timestamps)
+        if len(records) != len(self.ELEMENTS) + 1:
+            missing = set(self.COLUMNS) - set(records)
+            raise ValueError(
+                f'Missing forecast elements {sorted(missing)} for station '
+                f'{station_id} in {self.path}')
         base_record = {
             'observation_type': 'forecast',
             'source': source,
@@ -97,28 +192,54 @@ class MOSMIXParser(Parser):
             'height': float(height),
         }
         # Turn dict of lists into list of dicts
-        yield from (
-            {**base_record, **dict(zip(records, row))}
-            for row in zip(*records.values())
-        )
+        for row in zip(*operator.itemgetter(*self.COLUMNS)(records)):
+            record = base_record.copy()
+            record.update(zip(self.COLUMNS, row))
+            yield record
 
 
 class ObservationsParser(Parser):
 
+    METADATA_FILENAME_RE = re.compile(r'Metadaten_Geographie_(\d+)\.txt')
+    PRODUCT_FILENAME_PREFIX = 'produkt_'
+
     elements = {}
     conversion_factors = {}
+    conversion_offsets = {}
+    element_conversions = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Resolve the unit conversion of each element once per class rather
+        # than looking it up for every row
+        cls.element_conversions = tuple(
+            (
+                element,
+                cls.conversion_factors.get(element, 1),
+                cls.conversion_offsets.get(element, 0),
+            )
+            for element in cls.elements)
 
     def parse(self):
         with zipfile.ZipFile(self.path) as zf:
-            station_id = self.parse_station_id(zf)
+            station_id, product_filename = self.parse_filenames(zf)
             lat_lon_history = self.parse_lat_lon_history(zf, station_id)
-            yield from self.parse_records(zf, station_id, lat_lon_history)
+            yield from self.parse_records(
+                zf, product_filename, station_id, lat_lon_history)
 
-    def parse_station_id(self, zf):
+    def parse_filenames(self, zf):
+        station_id = None
+        product_filenames = []
         for filename in zf.namelist():
-            if (m := re.match(r'Metadaten_Geographie_(\d+)\.txt', filename)):
-                return m.group(1)
-        raise ValueError(f"Unable to parse station ID for {self.path}")
+            if filename.startswith(self.PRODUCT_FILENAME_PREFIX):
+                product_filenames.append(filename)
+            elif not station_id and (
+                    m := self.METADATA_FILENAME_RE.match(filename)):
+                station_id = m.group(1)
+        if not station_id:
+            raise ValueError(f"Unable to parse station ID for {self.path}")
+        assert len(product_filenames) == 1, "Unexpected product count"
+        return station_id, product_filenames[0]
 
     def parse_lat_lon_history(self, zf, station_id):
         with zf.open(f'Metadaten_Geographie_{station_id}.txt') as f:
@@ -129,51 +250,61 @@ class ObservationsParser(Parser):
             for row in reader:
                 date_from = datetime.datetime.strptime(
                     row['von_datum'].strip(), '%Y%m%d'
-                ).replace(tzinfo=tzutc())
+                ).replace(tzinfo=datetime.timezone.utc)
                 history[date_from] = (
                     float(row['Geogr.Laenge']),
                     float(row['Geogr.Breite']),
                     float(row['Stationshoehe']))
             return history
 
-    def parse_records(self, zf, station_id, lat_lon_history):
-        product_filenames = [
-            fn for fn in zf.namelist() if fn.startswith('produkt_')]
-        assert len(product_filenames) == 1, "Unexpected product count"
-        filename = product_filenames[0]
+    def parse_records(self, zf, filename, station_id, lat_lon_history):
+        location_dates = sorted(lat_lon_history)
+        locations = [lat_lon_history[date] for date in location_dates]
+        source = f'Observations:Recent:{filename}'
         with zf.open(filename) as f:
-            reader = csv.DictReader(
+            reader = csv.reader(
                 io.TextIOWrapper(f, encoding='latin1'),
                 delimiter=';')
+            header = next(reader)
+            timestamp_idx = header.index('MESS_DATUM')
+            element_idxs = [header.index(k) for k in self.elements.values()]
             for row in reader:
-                timestamp = datetime.datetime.strptime(
-                    row['MESS_DATUM'], '%Y%m%d%H').replace(tzinfo=tzutc())
-                for date, lat_lon_height in lat_lon_history.items():
-                    if date > timestamp:
-                        break
-                    lat, lon, height = lat_lon_height
+                # Much faster than strptime(mess_datum, '%Y%m%d%H')
+                mess_datum = row[timestamp_idx]
+                timestamp = datetime.datetime(
+                    int(mess_datum[:4]), int(mess_datum[4:6]),
+                    int(mess_datum[6:8]), int(mess_datum[8:10]),
+                    tzinfo=datetime.timezone.utc)
+                # Fall back to the earliest known location for records
+                # preceding the station history
+                location_idx = max(
+                    bisect.bisect_right(location_dates, timestamp) - 1, 0)
+                lat, lon, height = locations[location_idx]
                 yield {
                     'observation_type': 'recent',
-                    'source': f'Observations:Recent:{filename}',
+                    'source': source,
                     'station_id': station_id,
                     'lat': lat,
                     'lon': lon,
                     'height': height,
                     'timestamp': timestamp,
-                    **self.parse_elements(row),
+                    **self.parse_elements([row[i] for i in element_idxs]),
                 }
 
-    def parse_elements(self, row):
-        elements = {
-            element: (
-                float(row[element_key])
-                if row[element_key].strip() != '-999'
-                else None)
-            for element, element_key in self.elements.items()
-        }
-        for element, factor in self.conversion_factors.items():
-            elements[element] *= factor
-            elements[element] = round(elements[element], 2)
+    def parse_elements(self, values):
+        elements = {}
+        for (element, factor, offset), value in zip(
+                self.element_conversions, values):
+            if value.strip() == '-999':
+                elements[element] = None
+            elif factor != 1 or offset:
+                # Avoids the much slower correctly-rounded code path of
+                # round(..., 2). The results only match round(..., 2) for
+                # values with at most two decimals, as provided by DWD
+                elements[element] = round(
+                    (float(value) * factor + offset) * 100) / 100
+            else:
+                elements[element] = float(value)
         return elements
 
 
@@ -182,12 +313,10 @@ class TemperatureObservationsParser(ObservationsParser):
     elements = {
         'temperature': 'TT_TU',
     }
-
-    def parse_elements(self, row):
-        elements = super().parse_elements(row)
-        # Convert °C to K
-        elements['temperature'] = round(elements['temperature'] + 273.15, 2)
-        return elements
+    conversion_offsets = {
+        # °C to K
+        'temperature': 273.15,
+    }
 
 
 class PrecipitationObservationsParser(ObservationsParser):
@@ -10,6 +10,10 @@ setup(
     install_requires=[
         'click',
         'coloredlogs',
+        # isal 1.8 dropped support for Python 3.8
+        'isal<1.8; python_version < "3.9"',
+        'isal; python_version >= "3.9"',
+        'lxml',
         'parsel',
         'psycopg2-binary',
         'python-dateutil',
@@ -1,5 +1,8 @@
 import datetime
+import struct
+import zipfile
 
+import pytest
 from dateutil.tz import tzutc
 
 from brightsky.parsers import (
@@ -46,6 +49,75 @@ def test_mosmix_parser(data_dir):
     }
 
 
+def test_mosmix_parser_handles_multiple_stations(data_dir):
+    p = MOSMIXParser(path=data_dir / 'MOSMIX_S_multiple_stations.kmz')
+    records = list(p.parse())
+    assert len(records) == 3 * 240
+    assert [r['station_id'] for r in records[::240]] == [
+        '01028', '01001', '10384']
+    assert is_subset(
+        {'station_id': '01001', 'lat': -8.67, 'lon': 70.93, 'height': 10.},
+        records[240])
+    assert is_subset(
+        {'station_id': '10384', 'lat': 13.4, 'lon': 52.47, 'height': 48.},
+        records[-1])
+
+
+def test_mosmix_parser_handles_small_chunks(data_dir):
+    for filename in ['MOSMIX_S.kmz', 'MOSMIX_S_multiple_stations.kmz']:
+        p = MOSMIXParser(path=data_dir / filename)
+        assert list(p.parse_kml(p.read_kml(chunk_size=7))) == list(p.parse())
+
+
+def test_mosmix_parser_rejects_missing_elements(data_dir):
+    p = MOSMIXParser(path=data_dir / 'MOSMIX_S_missing_element.kmz')
+    with pytest.raises(ValueError, match='wind_speed'):
+        list(p.parse())
+
+
+def test_mosmix_parser_does_not_resolve_entities(data_dir, tmp_path):
+    secret_path = tmp_path / 'secret.txt'
+    secret_path.write_text('secret')
+    with zipfile.ZipFile(data_dir / 'MOSMIX_S.kmz') as zf:
+        kml = zf.read('MOSMIX_S.kml').decode('latin1')
+    doctype = (
+        f'<!DOCTYPE kml:kml [<!ENTITY x SYSTEM "{secret_path.as_uri()}">]>')
+    kml = kml.replace('?>', f'?>\n{doctype}', 1).replace(
+        '<kml:name>01028<', '<kml:name>01028&x;<')
+    with zipfile.ZipFile(
+            tmp_path / 'MOSMIX_S.kmz', 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('MOSMIX_S.kml', kml.encode('latin1'))
+    p = MOSMIXParser(path=tmp_path / 'MOSMIX_S.kmz')
+    records = list(p.parse())
+    assert len(records) == 240
+    assert 'secret' not in records[0]['station_id']
+
+
+def test_mosmix_parser_checks_crc(data_dir, tmp_path):
+    path = data_dir / 'MOSMIX_S.kmz'
+    with zipfile.ZipFile(path) as zf:
+        crc = zf.infolist()[0].CRC
+    # The CRC is stored in both the local and the central directory header
+    tmp_path.joinpath('MOSMIX_S.kmz').write_bytes(
+        path.read_bytes().replace(
+            struct.pack('<L', crc), struct.pack('<L', crc ^ 1)))
+    p = MOSMIXParser(path=tmp_path / 'MOSMIX_S.kmz')
+    with pytest.raises(zipfile.BadZipFile, match='Bad CRC-32'):
+        list(p.parse())
+
+
+def test_mosmix_parser_checks_compressed_size(data_dir, tmp_path):
+    data = bytearray((data_dir / 'MOSMIX_S.kmz').read_bytes())
+    # Claim a compressed size beyond the end of the archive in the central
+    # directory header
+    size_offset = data.index(b'PK\x01\x02') + 20
+    data[size_offset:size_offset+4] = struct.pack('<L', len(data))
+    tmp_path.joinpath('MOSMIX_S.kmz').write_bytes(data)
+    p = MOSMIXParser(path=tmp_path / 'MOSMIX_S.kmz')
+    with pytest.raises(zipfile.BadZipFile, match='Unexpected end of file'):
+        list(p.parse())
+
+
 def test_observations_parser_parses_metadata(data_dir):
     p = WindObservationsParser(path=data_dir / 'observations_recent_FF.zip')
     metadata = {
@@ -69,6 +141,15 @@ def test_observations_parser_handles_missing_values(data_dir):
     assert records[5]['wind_speed'] is None
 
 
+def test_observations_parser_handles_missing_converted_values():
+    p = SunshineObservationsParser()
+    assert p.parse_elements(['   5.00']) == {'sunshine': 300.}
+    assert p.parse_elements([' -999']) == {'sunshine': None}
+    p = TemperatureObservationsParser()
+    assert p.parse_elements(['  13.7']) == {'temperature': 286.85}
+    assert p.parse_elements([' -999']) == {'temperature': None}
+
+
 def test_observations_parser_handles_location_changes(data_dir):
     p = WindObservationsParser(
         path=data_dir / 'observations_recent_FF_location_change.zip')
@@ -79,6 +160,19 @@ def test_observations_parser_handles_location_changes(data_dir):
         {'lat': 13.0, 'lon': 50.0, 'height': 345.0}, records[-1])
 
 
+def test_observations_parser_handles_records_preceding_location_history(
+        data_dir):
+    p = WindObservationsParser(
+        path=data_dir / 'observations_recent_FF_location_history_gap.zip')
+    records = list(p.parse())
+    # Location history only starts on 2019-01-01
+    for record in records[:5]:
+        assert is_subset(
+            {'lat': 12.5597, 'lon': 48.8275, 'height': 350.5}, record)
+    assert is_subset(
+        {'lat': 13.0, 'lon': 50.0, 'height': 345.0}, records[-1])
+
+
 def _test_parser(cls, path, first, last, count=10, first_idx=0, last_idx=-1):
     p = cls(path=path)
     records = list(p.parse())